@@ -4,6 +4,8 @@ from src.datamodules.normalization import (
     imagenet_normalization
 )
 
+from src.datamodules.utils import worker_kwargs
+
 from src.datamodules.cifar10 import CIFAR10DataModule
 from src.datamodules.stl10 import STL10DataModule
 from src.datamodules.imagenet_dataset import SSLImagenet
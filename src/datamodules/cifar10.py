@@ -8,6 +8,7 @@ from torch.utils.data import DataLoader, random_split
 import torchvision.transforms as transforms
 from torchvision.datasets import CIFAR10
 from src.datamodules import cifar10_normalization
+from src.datamodules import worker_kwargs
 
 
 class CIFAR10DataModule(LightningDataModule):
@@ -22,6 +23,8 @@ class CIFAR10DataModule(LightningDataModule):
             num_workers: int = 16,
             batch_size: int = 32,
             seed: int = 42,
+            persistent_workers: bool = False,
+            prefetch_factor: int = 2,
             *args,
             **kwargs,
     ):
@@ -31,6 +34,8 @@ class CIFAR10DataModule(LightningDataModule):
             val_split: how many of the training images to use for the validation split
             num_workers: how many workers to use for loading data
             batch_size: number of examples per training/eval step
+            persistent_workers: keep data workers alive between epochs
+            prefetch_factor: number of batches loaded in advance by each worker
         """
         super().__init__(*args, **kwargs)
 
@@ -43,6 +48,8 @@ class CIFAR10DataModule(LightningDataModule):
         self.data_dir = data_dir if data_dir is not None else os.getcwd()
         self.num_samples = 50000 - val_split
 
+        self.worker_kwargs = worker_kwargs(num_workers, persistent_workers, prefetch_factor)
+
     @property
     def num_classes(self):
         """
@@ -76,6 +83,7 @@ class CIFAR10DataModule(LightningDataModule):
             batch_size=self.batch_size,
             shuffle=True,
             num_workers=self.num_workers,
+            **self.worker_kwargs,
             drop_last=True,
             pin_memory=True
         )
@@ -99,6 +107,7 @@ class CIFAR10DataModule(LightningDataModule):
             batch_size=self.batch_size,
             shuffle=False,
             num_workers=self.num_workers,
+            **self.worker_kwargs,
             pin_memory=True,
             drop_last=True
         )
@@ -116,6 +125,7 @@ class CIFAR10DataModule(LightningDataModule):
             batch_size=self.batch_size,
             shuffle=False,
             num_workers=self.num_workers,
+            **self.worker_kwargs,
             drop_last=True,
             pin_memory=True
         )
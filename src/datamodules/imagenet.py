@@ -8,6 +8,7 @@ from torch.utils.data import DataLoader
 import torchvision.transforms as transforms
 from src.datamodules import SSLImagenet
 from src.datamodules import imagenet_normalization
+from src.datamodules import worker_kwargs
 
 
 class ImagenetDataModule(LightningDataModule):
@@ -50,6 +51,8 @@ class ImagenetDataModule(LightningDataModule):
             image_size: int = 224,
             num_workers: int = 16,
             batch_size: int = 32,
+            persistent_workers: bool = False,
+            prefetch_factor: int = 2,
             *args,
             **kwargs,
     ):
@@ -61,6 +64,8 @@ class ImagenetDataModule(LightningDataModule):
             image_size: final image size
             num_workers: how many data workers
             batch_size: batch_size
+            persistent_workers: keep data workers alive between epochs
+            prefetch_factor: number of batches loaded in advance by each worker
         """
         super().__init__(*args, **kwargs)
 
@@ -73,6 +78,8 @@ class ImagenetDataModule(LightningDataModule):
         self.batch_size = batch_size
         self.num_samples = 1281167 - self.num_imgs_per_val_class * self.num_classes
 
+        self.worker_kwargs = worker_kwargs(num_workers, persistent_workers, prefetch_factor)
+
     @property
     def num_classes(self):
         """
@@ -138,6 +145,7 @@ class ImagenetDataModule(LightningDataModule):
             batch_size=self.batch_size,
             shuffle=True,
             num_workers=self.num_workers,
+            **self.worker_kwargs,
             drop_last=True,
             pin_memory=True
         )
@@ -167,6 +175,7 @@ class ImagenetDataModule(LightningDataModule):
             batch_size=self.batch_size,
             shuffle=False,
             num_workers=self.num_workers,
+            **self.worker_kwargs,
             pin_memory=True
         )
 
@@ -191,6 +200,7 @@ class ImagenetDataModule(LightningDataModule):
             batch_size=self.batch_size,
             shuffle=False,
             num_workers=self.num_workers,
+            **self.worker_kwargs,
             drop_last=True,
             pin_memory=True
         )
@@ -9,6 +9,7 @@ from torch.utils.data import DataLoader, random_split
 import torchvision.transforms as transforms
 from torchvision.datasets import STL10
 from src.datamodules import stl10_normalization
+from src.datamodules import worker_kwargs
 
 
 class ConcatDataset(Dataset):
@@ -40,6 +41,8 @@ class STL10DataModule(LightningDataModule):
             num_workers: int = 16,
             batch_size: int = 32,
             seed: int = 42,
+            persistent_workers: bool = False,
+            prefetch_factor: int = 2,
             *args,
             **kwargs,
     ):
@@ -50,6 +53,8 @@ class STL10DataModule(LightningDataModule):
             train_val_split: how many images from the labeled training split to use for validation
             num_workers: how many workers to use for loading data
             batch_size: the batch size
+            persistent_workers: keep data workers alive between epochs
+            prefetch_factor: number of batches loaded in advance by each worker
         """
         super().__init__(*args, **kwargs)
 
@@ -63,6 +68,8 @@ class STL10DataModule(LightningDataModule):
         self.num_unlabeled_samples = 100000 - unlabeled_val_split
         self.num_labeled_samples = 5000 - train_val_split
 
+        self.worker_kwargs = worker_kwargs(num_workers, persistent_workers, prefetch_factor)
+
     @property
     def num_classes(self):
         return 10
@@ -91,6 +98,7 @@ class STL10DataModule(LightningDataModule):
             batch_size=self.batch_size,
             shuffle=True,
             num_workers=self.num_workers,
+            **self.worker_kwargs,
             drop_last=True,
             pin_memory=True
         )
@@ -129,6 +137,7 @@ class STL10DataModule(LightningDataModule):
             batch_size=self.batch_size,
             shuffle=True,
             num_workers=self.num_workers,
+            **self.worker_kwargs,
             drop_last=True,
             pin_memory=True
         )
@@ -156,6 +165,7 @@ class STL10DataModule(LightningDataModule):
             batch_size=self.batch_size,
             shuffle=False,
             num_workers=self.num_workers,
+            **self.worker_kwargs,
             pin_memory=True
         )
         return loader
@@ -198,6 +208,7 @@ class STL10DataModule(LightningDataModule):
             batch_size=self.batch_size,
             shuffle=False,
             num_workers=self.num_workers,
+            **self.worker_kwargs,
             drop_last=True,
             pin_memory=True
         )
@@ -219,6 +230,7 @@ class STL10DataModule(LightningDataModule):
             batch_size=self.batch_size,
             shuffle=False,
             num_workers=self.num_workers,
+            **self.worker_kwargs,
             drop_last=True,
             pin_memory=True
         )
@@ -237,6 +249,7 @@ class STL10DataModule(LightningDataModule):
             batch_size=self.batch_size,
             shuffle=False,
             num_workers=self.num_workers,
+            **self.worker_kwargs,
             pin_memory=True
         )
         return loader
@@ -257,6 +270,7 @@ class STL10DataModule(LightningDataModule):
             batch_size=self.batch_size,
             shuffle=False,
             num_workers=self.num_workers,
+            **self.worker_kwargs,
             drop_last=True,
             pin_memory=True
         )
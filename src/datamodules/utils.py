@@ -0,0 +1,12 @@
+def worker_kwargs(num_workers: int, persistent_workers: bool = False, prefetch_factor: int = 2):
+    """
+    DataLoader worker options, these are only valid with multiprocess loading
+
+    Args:
+        num_workers: how many workers to use for loading data
+        persistent_workers: keep data workers alive between epochs
+        prefetch_factor: number of batches loaded in advance by each worker
+    """
+    if num_workers == 0:
+        return {}
+    return {"persistent_workers": bool(persistent_workers), "prefetch_factor": prefetch_factor}
@@ -19,17 +19,18 @@ class ProjectionHeadAE(nn.Module):
 
 
 class ProjectionHeadVAE(nn.Module):
-    def __init__(self, input_dim=2048, hidden_dim=2048, output_dim=128):
+    def __init__(self, input_dim=2048, hidden_dim=2048, output_dim=128, linear_layer=nn.Linear):
         super(ProjectionHeadVAE, self).__init__()
 
+        # linear_layer allows drop-in replacements such as transformer_engine's fp8 Linear
         self.first_layer = nn.Sequential(
-            nn.Linear(input_dim, hidden_dim, bias=True),
+            linear_layer(input_dim, hidden_dim, bias=True),
             nn.BatchNorm1d(hidden_dim),
             nn.ReLU(),
         )
 
-        self.mu = nn.Linear(hidden_dim, output_dim, bias=False)
-        self.logvar = nn.Linear(hidden_dim, output_dim, bias=False)
+        self.mu = linear_layer(hidden_dim, output_dim, bias=False)
+        self.logvar = linear_layer(hidden_dim, output_dim, bias=False)
 
     def forward(self, x):
         x = self.first_layer(x)
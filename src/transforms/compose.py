@@ -20,6 +20,7 @@ class TrainTransform:
         jitter_strength: float = 1.0,
         normalize=None,
         online_ft: bool = False,
+        uint8: bool = False,
     ) -> None:
         self.online_ft = online_ft
 
@@ -29,19 +30,20 @@ class TrainTransform:
                 jitter_strength=jitter_strength,
                 gaussian_blur=gaussian_blur,
                 normalize=normalize,
+                uint8=uint8,
             )
         else:
             self.input_transform = OriginalTransform(
-                dataset=dataset, normalize=normalize
+                dataset=dataset, normalize=normalize, uint8=uint8
             )
 
         self.original_transform = OriginalTransform(
-            dataset=dataset, normalize=normalize
+            dataset=dataset, normalize=normalize, uint8=uint8
         )
 
         if self.online_ft:
             self.finetune_transform = LinearEvalTrainTransform(
-                dataset=dataset, normalize=normalize
+                dataset=dataset, normalize=normalize, uint8=uint8
             )
 
     def __call__(self, x):
@@ -67,6 +69,7 @@ class EvalTransform:
         jitter_strength: float = 1.0,
         normalize=None,
         online_ft: bool = False,
+        uint8: bool = False,
     ) -> None:
         self.online_ft = online_ft
 
@@ -76,19 +79,20 @@ class EvalTransform:
                 jitter_strength=jitter_strength,
                 gaussian_blur=gaussian_blur,
                 normalize=normalize,
+                uint8=uint8,
             )
         else:
             self.input_transform = OriginalTransform(
-                dataset=dataset, normalize=normalize
+                dataset=dataset, normalize=normalize, uint8=uint8
             )
 
         self.original_transform = OriginalTransform(
-            dataset=dataset, normalize=normalize
+            dataset=dataset, normalize=normalize, uint8=uint8
         )
 
         if self.online_ft:
             self.finetune_transform = LinearEvalValidTransform(
-                dataset=dataset, normalize=normalize
+                dataset=dataset, normalize=normalize, uint8=uint8
             )
 
     def __call__(self, x):
@@ -2,6 +2,13 @@ import torchvision.transforms as transforms
 import numpy as np
 
 
+def to_tensor_transform(uint8=False):
+    """
+    uint8 keeps images as raw bytes so they can be converted to float (and normalized) on device
+    """
+    return transforms.PILToTensor() if uint8 else transforms.ToTensor()
+
+
 class SimCLRTransform:
     def __init__(
         self,
@@ -9,6 +16,7 @@ class SimCLRTransform:
         gaussian_blur: bool = True,
         jitter_strength: float = 1.0,
         normalize=None,
+        uint8: bool = False,
     ) -> None:
 
         self.color_jitter = transforms.ColorJitter(
@@ -36,11 +44,12 @@ class SimCLRTransform:
 
         data_transforms = transforms.Compose(data_transforms)
 
+        to_tensor = to_tensor_transform(uint8)
         if normalize is None:
-            self.final_transform = transforms.ToTensor()
+            self.final_transform = to_tensor
         else:
             self.final_transform = transforms.Compose(
-                [transforms.ToTensor(), normalize]
+                [to_tensor, normalize]
             )
 
         self.transform = transforms.Compose([data_transforms, self.final_transform])
@@ -54,24 +63,26 @@ class LinearEvalTrainTransform:
     Augmentation for training of classification MLP
     """
 
-    def __init__(self, dataset="cifar10", normalize=None):
+    def __init__(self, dataset="cifar10", normalize=None, uint8=False):
+        to_tensor = to_tensor_transform(uint8)
+
         if dataset == "cifar10":
             data_transforms = [
                 transforms.RandomCrop(32, padding=4, padding_mode="reflect"),
                 transforms.RandomHorizontalFlip(),
-                transforms.ToTensor(),
+                to_tensor,
             ]
         elif dataset == "imagenet":
             data_transforms = [
                 transforms.RandomResizedCrop(224),
                 transforms.RandomHorizontalFlip(),
-                transforms.ToTensor(),
+                to_tensor,
             ]
         elif dataset == "stl10":
             data_transforms = [
                 transforms.RandomResizedCrop(96),
                 transforms.RandomHorizontalFlip(),
-                transforms.ToTensor(),
+                to_tensor,
             ]
         else:
             raise ValueError(f"dataset {dataset} not supported")
@@ -89,22 +100,24 @@ class LinearEvalValidTransform:
     Preprocessing for evaluation of classification MLP
     """
 
-    def __init__(self, dataset="cifar10", normalize=None):
+    def __init__(self, dataset="cifar10", normalize=None, uint8=False):
+        to_tensor = to_tensor_transform(uint8)
+
         if dataset == "cifar10":
             data_transforms = [
-                transforms.ToTensor(),
+                to_tensor,
             ]
         elif dataset == "imagenet":
             data_transforms = [
                 transforms.Resize(256),
                 transforms.CenterCrop(224),
-                transforms.ToTensor(),
+                to_tensor,
             ]
         elif dataset == "stl10":
             data_transforms = [
                 transforms.Resize(int(96 * 1.1)),
                 transforms.CenterCrop(96),
-                transforms.ToTensor(),
+                to_tensor,
             ]
         else:
             raise ValueError(f"dataset {dataset} not supported")
@@ -2,8 +2,11 @@ import torch
 import torchvision
 import torch.nn as nn
 import torch.nn.functional as F
+import math
 import argparse
-import numpy as np
+import inspect
+import functools
+import contextlib
 
 from torch.optim import Adam
 from typing import Union, List, Optional, Sequence, Dict, Iterator, Tuple, Callable
@@ -11,6 +14,14 @@ from typing import Union, List, Optional, Sequence, Dict, Iterator, Tuple, Calla
 import pytorch_lightning as pl
 from pytorch_lightning.callbacks import LearningRateMonitor
 from pytorch_lightning.callbacks import ModelCheckpoint
+from pytorch_lightning.strategies import DDPStrategy
+from pytorch_lightning.utilities import apply_to_collection, rank_zero_warn
+
+try:
+    import transformer_engine.pytorch as te
+    from transformer_engine.common.recipe import DelayedScaling
+except ImportError:
+    te = None
 
 from src.models import ProjectionHeadVAE
 from src.models import resnet18, resnet34, resnet50, resnet50w2, resnet50w4
@@ -38,6 +49,47 @@ DECODERS = {
     "decoder50w4": decoder50w4,
 }
 
+# constructor args that only change how a run executes, not the model, kept out of checkpoints
+RUNTIME_ARGS = ("compile_model", "compile_step", "log_marginal", "channels_last")
+
+LOG_2 = math.log(2.)
+LOG_2PI = math.log(2 * math.pi)
+
+
+@torch.jit.script
+def gaussian_log_prob(mean: torch.Tensor, scale: torch.Tensor, sample: torch.Tensor) -> torch.Tensor:
+    """
+    elementwise log N(sample; mean, scale), scripted so the chain is fused into one kernel
+    """
+    return -0.5 * ((sample - mean) / scale) ** 2 - torch.log(scale) - 0.5 * LOG_2PI
+
+
+@torch.jit.script
+def scaled_squared_error(mean: torch.Tensor, inv_scale: torch.Tensor, sample: torch.Tensor) -> torch.Tensor:
+    """
+    ((sample - mean) * inv_scale) ** 2 summed over (c, h, w), inv_scale broadcasts as a scalar
+    """
+    return (((sample - mean) * inv_scale) ** 2).sum(dim=[1, 2, 3])
+
+
+@torch.jit.script
+def standard_normal_kl(mu: torch.Tensor, log_var: torch.Tensor) -> torch.Tensor:
+    """
+    KL(N(mu, exp(log_var / 2)) || N(0, 1)) summed over the latent dim
+    """
+    return (0.5 * (mu ** 2 + log_var.exp() - 1. - log_var)).sum(dim=-1)
+
+
+@torch.jit.script
+def normal_kl(mu_q: torch.Tensor, std_q: torch.Tensor, mu_p: torch.Tensor, std_p: torch.Tensor) -> torch.Tensor:
+    """
+    KL(N(mu_q, std_q) || N(mu_p, std_p)) summed over the latent dim
+    """
+    var_ratio = (std_q / std_p) ** 2
+    t1 = ((mu_q - mu_p) / std_p) ** 2
+
+    return (0.5 * (var_ratio + t1 - 1. - torch.log(var_ratio))).sum(dim=-1)
+
 
 class VAE(pl.LightningModule):
     def __init__(
@@ -66,11 +118,24 @@ class VAE(pl.LightningModule):
         weight_decay,
         exclude_bn_bias,
         online_ft,
+        compile_model=False,
+        compile_step=False,
+        log_marginal=False,
+        channels_last=False,
+        norm_mean=None,
+        norm_std=None,
+        fp8=False,
         **kwargs,
     ) -> None:
         super(VAE, self).__init__()
 
-        self.save_hyperparameters()
+        # persist the named constructor args needed to rebuild the model, not the cli namespace
+        # in kwargs or the runtime-only switches. read from the signature so a new required
+        # argument can't silently drop out and break load_from_checkpoint(path)
+        self.save_hyperparameters(*[
+            name for name, param in inspect.signature(VAE.__init__).parameters.items()
+            if name != "self" and param.kind != param.VAR_KEYWORD and name not in RUNTIME_ARGS
+        ])
 
         self.input_height = input_height
         self.num_samples = num_samples
@@ -79,6 +144,17 @@ class VAE(pl.LightningModule):
 
         self.gpus = gpus
         self.online_ft = online_ft
+        # in-place Module.compile keeps state_dict keys intact for linear_eval
+        self.compile_model = (
+            compile_model and torch.cuda.is_available() and hasattr(nn.Module, "compile")
+        )
+        # whole step capture subsumes the per-module compile
+        self.compile_step = compile_step and torch.cuda.is_available() and hasattr(torch, "compile")
+        self.compile_model = self.compile_model and not self.compile_step
+        if compile_step and not self.compile_step:
+            rank_zero_warn("compile_step requires cuda and torch>=2.0, running the step eagerly")
+        if compile_model and not self.compile_model and not self.compile_step:
+            rank_zero_warn("compile_model requires cuda and torch>=2.2, running the modules eagerly")
 
         self.optimizer = optimizer
         self.learning_rate = learning_rate
@@ -100,6 +176,18 @@ class VAE(pl.LightningModule):
         self.learn_scale = learn_scale
         self.log_scale = log_scale
         self.val_samples = val_samples
+        self.log_marginal = log_marginal
+        self.channels_last = channels_last
+        # fp8 tensor cores need hopper (sm90) and transformer_engine
+        self.fp8 = (
+            fp8 and te is not None and torch.cuda.is_available()
+            and torch.cuda.get_device_capability()[0] >= 9
+        )
+        if fp8 and not self.fp8:
+            rank_zero_warn("fp8 requires transformer_engine and a sm90+ gpu, falling back to bf16/fp32")
+        # record the effective value so checkpoints rebuild the layers they were trained with,
+        # fp8 checkpoints hold te.Linear _extra_state and only strict-load where te is installed
+        self.hparams.fp8 = self.fp8
 
         global_batch_size = (
             self.gpus * self.batch_size if self.gpus > 0 else self.batch_size
@@ -119,67 +207,127 @@ class VAE(pl.LightningModule):
         )
 
         self.projection = ProjectionHeadVAE(
-            input_dim=self.h_dim, hidden_dim=self.h_dim, output_dim=self.latent_dim
+            input_dim=self.h_dim,
+            hidden_dim=self.h_dim,
+            output_dim=self.latent_dim,
+            linear_layer=te.Linear if self.fp8 else nn.Linear,
         )
+        self.fp8_recipe = DelayedScaling() if self.fp8 else None
 
         self.cosine_similarity = nn.CosineSimilarity(dim=1, eps=1e-6)
 
+        # per-channel normalization applied on device, see on_after_batch_transfer
+        if norm_mean is not None:
+            self.register_buffer("norm_mean", torch.tensor(norm_mean).view(1, -1, 1, 1), persistent=False)
+            self.register_buffer("norm_std", torch.tensor(norm_std).view(1, -1, 1, 1), persistent=False)
+        else:
+            self.norm_mean = None
+            self.norm_std = None
+
         # start log-scale with a specific value
         self.log_scale = nn.Parameter(torch.Tensor([self.log_scale]))
         self.log_scale.requires_grad = bool(self.learn_scale)
 
+        if self.channels_last:
+            # nhwc lets cudnn use tensor cores without layout transposes
+            self.encoder = self.encoder.to(memory_format=torch.channels_last)
+            self.decoder = self.decoder.to(memory_format=torch.channels_last)
+
+        if self.compile_model:
+            # batch shapes are static, so cuda graphs can be used for the resnets,
+            # compilation happens lazily on the first training step
+            self.encoder.compile(mode="reduce-overhead")
+            self.decoder.compile(mode="reduce-overhead")
+            self.projection.compile(mode="max-autotune")
+
     def on_train_start(self):
         self.logger.log_hyperparams(self.hparams)
 
+    def preprocess(self, x):
+        # only raw uint8 images are ours to convert, float inputs (e.g. the datamodules'
+        # default transforms) are already normalized and labels are left untouched
+        if x.dtype != torch.uint8:
+            return x
+
+        # float() makes a new tensor, so the in-place ops never touch the loader's batch
+        x = x.float().div_(255.)
+        if self.norm_mean is not None:
+            x = x.sub_(self.norm_mean).div_(self.norm_std)
+        return x
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        # all image views are dequantized and normalized in one op on device
+        # instead of per sample in the workers
+        return apply_to_collection(batch, torch.Tensor, self.preprocess)
+
+    def projection_precision(self):
+        # only the projection gemms run in fp8, the resnets stay in bf16/fp32
+        if self.fp8:
+            return te.fp8_autocast(enabled=True, fp8_recipe=self.fp8_recipe)
+        return contextlib.nullcontext()
+
+    def to_memory_format(self, x):
+        if self.channels_last:
+            return x.contiguous(memory_format=torch.channels_last)
+        return x
+
     def forward(self, x):
-        return self.encoder(x)
+        return self.encoder(self.to_memory_format(x))
 
-    def sample(self, z_mu, z_var, eps=1e-6):
+    @staticmethod
+    def posterior_std(z_var, eps=1e-6):
         """
-        z_mu and z_var is (batch, dim)
+        z_var is (batch, dim)
         """
         # add eps to prevent 0 variance
-        std = torch.exp(z_var / 2.) + eps
-
-        p = torch.distributions.Normal(torch.zeros_like(z_mu), torch.ones_like(std))
-        q = torch.distributions.Normal(z_mu, std)
-        z = q.rsample()
+        return torch.exp(z_var / 2.) + eps
 
-        return p, q, z
+    @staticmethod
+    def sample(z_mu, std):
+        """
+        z_mu and std is (batch, dim)
+        """
+        return z_mu + std * torch.randn_like(std)
 
     @staticmethod
-    def kl_divergence_mc(p, q, z):
+    def kl_divergence_mc(mu, std, z):
         """
-        z is (batch, dim)
+        mu, std and z are (batch, dim), prior is N(0, 1)
         """
-        log_pz = p.log_prob(z)
-        log_qz = q.log_prob(z)
+        # the prior needs no loc/scale tensors, its normaliser is added once per sample
+        log_pz = -0.5 * (z ** 2).sum(dim=-1) - 0.5 * z.size(-1) * LOG_2PI
+        log_qz = gaussian_log_prob(mu, std, z).sum(dim=-1)
 
-        kl = (log_qz - log_pz).sum(dim=-1)
-        log_pz = log_pz.sum(dim=-1)
-        log_qz = log_qz.sum(dim=-1)
+        kl = log_qz - log_pz
 
         return kl, log_pz, log_qz
 
     @staticmethod
-    def kl_divergence_analytic(p, q, z):
+    def kl_divergence_analytic(mu, log_var):
         """
-        z is (batch, dim)
+        closed form KL(N(mu, exp(log_var / 2)) || N(0, 1)), mu and log_var are (batch, dim)
         """
-        kl = torch.distributions.kl.kl_divergence(q, p).sum(dim=-1)
-        log_pz = p.log_prob(z).sum(dim=-1)
-        log_qz = q.log_prob(z).sum(dim=-1)
+        return standard_normal_kl(mu, log_var)
 
-        return kl, log_pz, log_qz
+    @staticmethod
+    def kl_divergence_normal(mu_q, std_q, mu_p, std_p):
+        """
+        closed form KL(N(mu_q, std_q) || N(mu_p, std_p)), all are (batch, dim)
+        """
+        return normal_kl(mu_q, std_q, mu_p, std_p)
 
     @staticmethod
     def gaussian_likelihood(mean, logscale, sample, eps=1e-6):
+        # keep the likelihood in fp32 under bf16/fp16 autocast
+        mean, sample = mean.float(), sample.float()
         scale = torch.exp(logscale / 2.) + eps
-        dist = torch.distributions.Normal(mean, scale)
-        log_pxz = dist.log_prob(sample)
+
+        # scale is shared by all pixels, so its normaliser is pulled out of the sum
+        pixels = sample[0].numel()
+        log_norm = pixels * (torch.log(scale) + 0.5 * LOG_2PI)
 
         # sum over dimensions
-        return log_pxz.sum(dim=(1, 2, 3))
+        return -0.5 * scaled_squared_error(mean, 1. / scale, sample) - log_norm
 
     def step(self, batch, samples=1):
         if self.dataset == "stl10":
@@ -191,37 +339,59 @@ class VAE(pl.LightningModule):
         else:
             (x, original), y = batch
 
+        # original is also the reconstruction target, keep it in the decoder's layout
+        x = self.to_memory_format(x)
+        original = self.to_memory_format(original)
+
         batch_size, c, h, w = x.shape
         pixels = c * h * w
 
+        # importance weighted estimate of log p(x) only makes sense with multiple samples
+        log_marginal = self.log_marginal or samples > 1
+
         # get representation of original image
         with torch.no_grad():
             x_original = self.encoder(original).clone().detach()
-            mu_orig, log_var_orig = self.projection(x_original)
+            with self.projection_precision():
+                mu_orig, log_var_orig = self.projection(x_original)
+            mu_orig, log_var_orig = mu_orig.float(), log_var_orig.float()
 
         x_enc = self.encoder(x)
-        mu, log_var = self.projection(x_enc)
+        with self.projection_precision():
+            mu, log_var = self.projection(x_enc)
+
+        # posterior params and the kl terms stay in fp32 under mixed precision
+        mu, log_var = mu.float(), log_var.float()
+
+        # the kl terms only depend on the posterior params, not on the drawn samples
+        std = self.posterior_std(log_var)
+        kl = self.kl_divergence_analytic(mu, log_var)
+
+        with torch.no_grad():
+            std_orig = self.posterior_std(log_var_orig)
+
+        # kl between original image and augmented image
+        kl_augmentation = self.kl_divergence_normal(mu, std, mu_orig, std_orig).mean()
 
         log_pzs = []
         log_qzs = []
         log_pxzs = []
 
-        kls = []
         elbos = []
         losses = []
         cos_sims = []
-        kl_augmentations = []
 
         for _ in range(samples):
-            p, q, z = self.sample(mu, log_var)
-            kl, log_pz, log_qz = self.kl_divergence_analytic(p, q, z)
+            z = self.sample(mu, std)
 
             with torch.no_grad():
-                _, q_orig, z_orig = self.sample(mu_orig, log_var_orig)
+                z_orig = self.sample(mu_orig, std_orig)
 
-            # kl between original image and augmented image
-            kl_aug = torch.distributions.kl.kl_divergence(q, q_orig).sum(dim=-1)
-            kl_augmentations.append(kl_aug)
+            # densities at z are only needed for the marginal likelihood estimate
+            if log_marginal:
+                _, log_pz, log_qz = self.kl_divergence_mc(mu, std, z)
+                log_pzs.append(log_pz)
+                log_qzs.append(log_qz)
 
             cos_sims.append(self.cosine_similarity(z_orig, z))
 
@@ -234,50 +404,58 @@ class VAE(pl.LightningModule):
             elbo = kl - log_pxz
             loss = self.kl_coeff * kl - log_pxz
 
-            log_pzs.append(log_pz)
-            log_qzs.append(log_qz)
             log_pxzs.append(log_pxz)
 
-            kls.append(kl)
             elbos.append(elbo)
             losses.append(loss)
 
         # all of these will be of shape [batch, samples, ... ]
-        log_pz = torch.stack(log_pzs, dim=1)
-        log_qz = torch.stack(log_qzs, dim=1)
         log_pxz = torch.stack(log_pxzs, dim=1)
 
-        kl = torch.stack(kls, dim=1)
         elbo = torch.stack(elbos, dim=1).mean()
         loss = torch.stack(losses, dim=1).mean()
 
         cos_sim = torch.stack(cos_sims, dim=1).mean()
-        kl_augmentation = torch.stack(kl_augmentations, dim=1).mean()
-
-        # marginal likelihood, logsumexp over sample dim, mean over batch dim
-        log_px = torch.logsumexp(log_pxz + log_pz - log_qz, dim=1).mean(dim=0) - np.log(
-            samples
-        )
-        bpd = -log_px / (pixels * np.log(2))  # need log_px in base 2
 
         logs = {
             "kl": kl.mean(),
             "elbo": elbo,
             "loss": loss,
-            "bpd": bpd,
             "cos_sim": cos_sim,
             "kl_augmentation": kl_augmentation,
             "log_pxz": log_pxz.mean(),
-            "log_pz": log_pz.mean(),
-            "log_px": log_px,
-            "log_scale": self.log_scale.item(),
+            "log_scale": self.log_scale.detach(),
         }
 
+        if log_marginal:
+            log_pz = torch.stack(log_pzs, dim=1)
+            log_qz = torch.stack(log_qzs, dim=1)
+
+            # marginal likelihood, logsumexp over sample dim, mean over batch dim
+            log_px = torch.logsumexp(log_pxz + log_pz - log_qz, dim=1).mean(dim=0) - math.log(samples)
+            logs["log_pz"] = log_pz.mean()
+            logs["log_px"] = log_px
+        else:
+            # single sample estimate is just the elbo, report its bound instead
+            log_px = -elbo
+
+        logs["bpd"] = -log_px / (pixels * LOG_2)  # need log_px in base 2
+
         return loss, logs
 
     def training_step(self, batch, batch_idx):
-        loss, logs = self.step(batch, samples=1)
-        self.log_dict({f"train_{k}": v for k, v in logs.items()})
+        if self.compile_step:
+            # record both encoder passes, decoder and loss math as one cuda graph per training step,
+            # train loaders use drop_last so shapes are static. validation stays eager since it runs
+            # under no_grad with val_samples and may see a partial last batch
+            loss, logs = compiled_step()(self, batch, samples=1)
+        else:
+            loss, logs = self.step(batch, samples=1)
+
+        # metrics stay on device and are reduced once at epoch end
+        self.log_dict(
+            {f"train_{k}": v for k, v in logs.items()}, on_step=False, on_epoch=True, sync_dist=False
+        )
 
         """
         if self.global_step % 1000 == 0:
@@ -324,7 +502,9 @@ class VAE(pl.LightningModule):
             params = self.parameters()
 
         if self.optimizer == 'adam':
-            optimizer = Adam(params, lr=self.learning_rate, weight_decay=self.weight_decay)
+            # multi-tensor update over all params instead of a per-param python loop (torch>=1.12)
+            extra_args = {"foreach": True} if "foreach" in inspect.signature(Adam).parameters else {}
+            optimizer = Adam(params, lr=self.learning_rate, weight_decay=self.weight_decay, **extra_args)
         elif self.optimizer == 'lamb':
             optimizer = LAMB(params, lr=self.learning_rate, weight_decay=self.weight_decay)
 
@@ -344,6 +524,18 @@ class VAE(pl.LightningModule):
 
         return [optimizer], [scheduler]
 
+    def optimizer_zero_grad(self, epoch, batch_idx, optimizer, optimizer_idx):
+        # release grads instead of a memset per parameter
+        optimizer.zero_grad(set_to_none=True)
+
+
+@functools.lru_cache(maxsize=None)
+def compiled_step():
+    """
+    compiled VAE.step, kept at module level so the model holds no reference to itself and stays picklable
+    """
+    return torch.compile(VAE.step, mode="reduce-overhead")
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -365,6 +557,7 @@ if __name__ == "__main__":
     parser.add_argument("--log_scale", type=float, default=0.)
     parser.add_argument("--learn_scale", type=int, default=0)  # default keep fixed log-scale
     parser.add_argument("--val_samples", type=int, default=1)
+    parser.add_argument("--log_marginal", action="store_true")  # log p(x) estimate even with 1 sample
 
     # optimizer param
     parser.add_argument("--optimizer", type=str, default="adam")  # adam/lamb
@@ -380,7 +573,12 @@ if __name__ == "__main__":
     # training params
     parser.add_argument("--gpus", type=int, default=1)
     parser.add_argument("--fp16", action="store_true")
+    parser.add_argument("--bf16", action="store_true")
+    parser.add_argument("--fp8", action="store_true")  # fp8 projection head, hopper + transformer_engine only
     parser.add_argument("--online_ft", action="store_true")
+    parser.add_argument("--compile_model", action="store_true")
+    parser.add_argument("--compile_step", action="store_true")
+    parser.add_argument("--channels_last", action="store_true")
 
     # datamodule params
     parser.add_argument("--data_path", type=str, default=".")
@@ -388,6 +586,8 @@ if __name__ == "__main__":
     parser.add_argument("--num_samples", type=int, default=1)
     parser.add_argument("--batch_size", type=int, default=128)
     parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument("--persistent_workers", type=int, default=1)  # keep workers alive between epochs
+    parser.add_argument("--prefetch_factor", type=int, default=4)
 
     # transforms param
     parser.add_argument("--input_height", type=int, default=32)
@@ -395,6 +595,16 @@ if __name__ == "__main__":
     parser.add_argument("--jitter_strength", type=float, default=1.0)
 
     args = parser.parse_args()
+
+    # let the profiling executor fuse the scripted likelihood/kl helpers for static shapes
+    if hasattr(torch.jit, "set_fusion_strategy"):
+        torch.jit.set_fusion_strategy([("STATIC", 20)])
+
+    # tf32 convs/matmuls on ampere+, input shapes are fixed so let cudnn autotune
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
+
     pl.seed_everything(args.seed)
 
     # set hidden dim for resnets
@@ -410,6 +620,8 @@ if __name__ == "__main__":
             data_dir=args.data_path,
             batch_size=args.batch_size,
             num_workers=args.num_workers,
+            persistent_workers=args.persistent_workers,
+            prefetch_factor=args.prefetch_factor,
         )
 
         args.num_samples = dm.num_samples
@@ -426,6 +638,8 @@ if __name__ == "__main__":
             data_dir=args.data_path,
             batch_size=args.batch_size,
             num_workers=args.num_workers,
+            persistent_workers=args.persistent_workers,
+            prefetch_factor=args.prefetch_factor,
         )
 
         dm.train_dataloader = dm.train_dataloader_mixed
@@ -444,6 +658,8 @@ if __name__ == "__main__":
             data_dir=args.data_path,
             batch_size=args.batch_size,
             num_workers=args.num_workers,
+            persistent_workers=args.persistent_workers,
+            prefetch_factor=args.prefetch_factor,
         )
 
         args.num_samples = dm.num_samples
@@ -458,14 +674,19 @@ if __name__ == "__main__":
     else:
         raise NotImplementedError("other datasets have not been implemented till now")
 
+    # images are sent as uint8 and normalized by the model after the batch is moved to the device
+    args.norm_mean = list(normalization.mean)
+    args.norm_std = list(normalization.std)
+
     dm.train_transforms = TrainTransform(
         denoising=args.denoising,
         input_height=args.input_height,
         dataset=args.dataset,
         gaussian_blur=args.gaussian_blur,
         jitter_strength=args.jitter_strength,
-        normalize=normalization,
+        normalize=None,
         online_ft=args.online_ft,
+        uint8=True,
     )
 
     dm.val_transforms = EvalTransform(
@@ -474,8 +695,9 @@ if __name__ == "__main__":
         dataset=args.dataset,
         gaussian_blur=args.gaussian_blur,
         jitter_strength=args.jitter_strength,
-        normalize=normalization,
+        normalize=None,
         online_ft=args.online_ft,
+        uint8=True,
     )
 
     # model init
@@ -501,13 +723,25 @@ if __name__ == "__main__":
         )
         callbacks.append(online_finetuner)
 
+    strategy = None
+    if args.gpus > 1:
+        # every param gets a grad each step, so skip the unused param scan and reuse the graph
+        ddp_kwargs = {"find_unused_parameters": False, "gradient_as_bucket_view": True}
+        # static_graph is only accepted by DistributedDataParallel from torch 1.11
+        if "static_graph" in inspect.signature(torch.nn.parallel.DistributedDataParallel).parameters:
+            ddp_kwargs["static_graph"] = True
+        strategy = DDPStrategy(**ddp_kwargs)
+
     trainer = pl.Trainer(
         max_epochs=args.max_epochs,
         gpus=args.gpus,
-        strategy="ddp" if args.gpus > 1 else None,
-        precision=16 if args.fp16 else 32,
+        strategy=strategy,
+        precision="bf16" if args.bf16 else (16 if args.fp16 else 32),
         callbacks=callbacks,
         resume_from_checkpoint=None if args.ckpt_path == '' else args.ckpt_path,
     )
 
+    # checkpoints only keep the model hparams, log the full run configuration for provenance
+    trainer.logger.log_hyperparams(vars(args))
+
     trainer.fit(model, dm)